@@ -136,6 +136,17 @@ download_files() {
         exit 1
     fi
     
+    # xray_snapshot.py
+    echo -ne "  → xray_snapshot.py ... "
+    if wget -q --timeout=30 -O "${INSTALL_DIR}/xray_snapshot.py" "${GITHUB_REPO}/xray_snapshot.py" 2>/dev/null; then
+        echo -e "${GREEN}✓${NC}"
+    else
+        echo -e "${RED}✗${NC}"
+        echo -e "${RED}Ошибка: не удалось скачать xray_snapshot.py${NC}"
+        echo -e "${YELLOW}Проверьте: ${GITHUB_REPO}/xray_snapshot.py${NC}"
+        exit 1
+    fi
+    
     # monitor_config.conf (только если нет backup)
     echo -ne "  → monitor_config.conf ... "
     if [[ -f "${CONFIG_PATH}.backup."* ]] && ls "${CONFIG_PATH}.backup."* 1> /dev/null 2>&1; then
@@ -186,6 +197,12 @@ SERVER_NAME=ES                      # Имя сервера (UK, USA-1, EU-Londo
 REFRESH_INTERVAL=2                  # Интервал обновления экрана (секунды)
 SYNC_INTERVAL=5                     # Интервал автосинхронизации (минуты)
 MIN_SYNC_MB=10                      # Минимальный трафик для синхронизации (MB)
+USER_TTL=3600                       # Забывать пропавших из Stats API (секунды, 0 - никогда)
+MAX_TRACKED_USERS=10000             # Максимум пользователей в памяти (0 - без лимита)
+
+# ===== SNAPSHOT SETTINGS =====
+SNAPSHOT_ENABLED=true               # Публиковать счётчики в shared memory
+SNAPSHOT_PATH=/run/xray-monitor/xray_monitor.snapshot
 
 # ===== DISPLAY SETTINGS =====
 CONSOLE_MODE=true                   # Показывать таблицу в консоли
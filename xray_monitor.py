@@ -12,15 +12,18 @@ import sys
 import os
 import json
 import requests
-from typing import Dict, Tuple, Optional
+from typing import Dict, Tuple, Optional, Set, List, Iterable
 from dataclasses import dataclass, field
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from itertools import islice
 from datetime import datetime
 
 # gRPC imports
 import grpc
 from grpc import aio as grpc_aio
 
+from xray_snapshot import SnapshotWriter, DEFAULT_SNAPSHOT_PATH
+
 # ============================================================================
 # PROTOBUF DEFINITIONS
 # ============================================================================
@@ -203,20 +206,27 @@ class TrafficData:
     down_speed: float = 0.0
     last_uplink: int = 0
     last_downlink: int = 0
+    last_seen: float = 0.0
 
 
 class TrafficAggregator:
-    def __init__(self):
-        self.users: Dict[str, TrafficData] = {}
+    def __init__(self, user_ttl: float = 0, max_users: int = 0):
+        # Порядок ключей = порядок последнего появления в Stats API (LRU)
+        self.users: Dict[str, TrafficData] = OrderedDict()
         self.total_up: int = 0
         self.total_down: int = 0
+        self.user_ttl = user_ttl
+        self.max_users = max_users
     
     def update(self, stats: Dict[str, Tuple[int, int]], interval: float) -> Dict[str, TrafficData]:
+        now = time.time()
         for email, (uplink, downlink) in stats.items():
             if email not in self.users:
                 self.users[email] = TrafficData()
             
             data = self.users[email]
+            data.last_seen = now
+            self.users.move_to_end(email)
             
             # Calculate speeds
             up_diff = uplink - data.last_uplink if uplink >= data.last_uplink else uplink
@@ -230,10 +240,120 @@ class TrafficAggregator:
             data.last_uplink = uplink
             data.last_downlink = downlink
         
+        # Пропавшие из опроса (в начале LRU) не передают трафик - скорость 0
+        for data in self.users.values():
+            if data.last_seen == now:
+                break
+            data.up_speed = 0.0
+            data.down_speed = 0.0
+        
         self.total_up = sum(d.uplink for d in self.users.values())
         self.total_down = sum(d.downlink for d in self.users.values())
         
         return self.users
+    
+    def stale_users(self, live: Dict[str, Tuple[int, int]], now: Optional[float] = None) -> List[str]:
+        """Пользователи, пропавшие из Stats API дольше TTL или вытесняемые по лимиту
+        
+        Лимит max_users мягкий: вытесняются только пропавшие из live,
+        счётчики, которые Xray ещё отдаёт, никогда не забываются
+        """
+        now = time.time() if now is None else now
+        stale = []
+        
+        if self.user_ttl > 0:
+            for email, data in self.users.items():
+                if now - data.last_seen < self.user_ttl:
+                    break
+                stale.append(email)
+        
+        if self.max_users > 0:
+            overflow = len(self.users) - len(stale) - self.max_users
+            for email in islice(self.users, len(stale), None):
+                if overflow <= 0 or email in live:
+                    break
+                stale.append(email)
+                overflow -= 1
+        
+        return stale
+    
+    def remove(self, emails: Iterable[str]):
+        for email in emails:
+            data = self.users.pop(email, None)
+            if data:
+                self.total_up -= data.uplink
+                self.total_down -= data.downlink
+
+
+# ============================================================================
+# XRAY USER INDEX
+# ============================================================================
+
+class XrayUserIndex:
+    """Список клиентов из конфига Xray (перечитывается только при смене mtime)
+    
+    Конфиг не используется как whitelist: клиенты могут добавляться через
+    API Xray. Удалёнными считаются только те, кто был в прошлой версии файла.
+    """
+    
+    def __init__(self, config_path: str):
+        self.config_path = config_path
+        self.emails: Optional[Set[str]] = None
+        # Удалённые из конфига, ожидающие финальной выгрузки
+        self.removed: Set[str] = set()
+        self._mtime: Optional[int] = None
+        self._failed_mtime: Optional[int] = None
+    
+    def refresh(self) -> bool:
+        """Возвращает True, если список клиентов был перечитан"""
+        try:
+            mtime = os.stat(self.config_path).st_mtime_ns
+        except OSError:
+            return False
+        
+        if mtime == self._mtime:
+            return False
+        
+        try:
+            with open(self.config_path, 'r') as f:
+                emails = self._parse_emails(json.load(f))
+        except (OSError, ValueError) as e:
+            if mtime != self._failed_mtime:
+                # Файл мог быть пойман посреди записи - повторим на следующем опросе
+                self._failed_mtime = mtime
+                return False
+            # JSON с комментариями, confdir и т.п. - ждём следующего изменения файла
+            self._mtime = mtime
+            print(f"⚠️  Could not read Xray config: {e}")
+            return False
+        
+        self._mtime = mtime
+        if not emails:
+            # Клиенты управляются не через файл - ничего не удаляем
+            return False
+        
+        if self.emails is not None:
+            self.removed |= self.emails - emails
+        self.removed -= emails
+        self.emails = emails
+        return True
+    
+    @staticmethod
+    def _parse_emails(xray_config) -> Set[str]:
+        if not isinstance(xray_config, dict):
+            raise ValueError("top-level value is not an object")
+        
+        emails = set()
+        for inbound in xray_config.get('inbounds') or []:
+            settings = inbound.get('settings') if isinstance(inbound, dict) else None
+            clients = settings.get('clients') if isinstance(settings, dict) else None
+            if not isinstance(clients, list):
+                continue
+            for client in clients:
+                email = client.get('email') if isinstance(client, dict) else None
+                if email and isinstance(email, str):
+                    emails.add(email)
+        return emails
 
 
 # ============================================================================
@@ -262,6 +382,7 @@ class BaserowSync:
         self._last_synced: Dict[str, int] = {}
         self._baseline: Dict[str, int] = {}  # Начальные значения при старте
         self._baseline_initialized = False
+        self._flush_retry_at: Dict[str, float] = {}  # Отложенные финальные выгрузки
         self._last_sync_time = time.time()
         
         self._load_state()
@@ -293,6 +414,45 @@ class BaserowSync:
         except Exception as e:
             print(f"⚠️  Could not save state: {e}")
     
+    def forget_users(self, emails: Iterable[str]):
+        """Удаляет пользователей из состояния синхронизации"""
+        removed = 0
+        for email in emails:
+            self._baseline.pop(email, None)
+            self._flush_retry_at.pop(email, None)
+            if self._last_synced.pop(email, None) is not None:
+                removed += 1
+        
+        if removed:
+            self._save_state()
+            print(f"🧹 Removed {removed} users from sync state")
+    
+    def prune_missing(self, live: Iterable[str]):
+        """Забывает сохранённых пользователей без счётчика в Xray
+        
+        Если счётчика нет, новый начнётся с нуля - состояние для него не нужно
+        """
+        live = set(live)
+        self.forget_users([email for email in self._last_synced if email not in live])
+    
+    def flush_user(self, email: str, uplink: int, downlink: int, retry_after: float) -> bool:
+        """Финальная выгрузка перед удалением, True - если дельты не осталось
+        
+        После ошибки следующая попытка не раньше чем через retry_after секунд
+        """
+        if not self.enabled or self._calculate_delta(email, uplink + downlink) <= 0:
+            return True
+        
+        now = time.time()
+        if now < self._flush_retry_at.get(email, 0):
+            return False
+        
+        if self.sync_user(email, uplink, downlink, force=True):
+            return True
+        
+        self._flush_retry_at[email] = now + retry_after
+        return False
+    
     def extract_username(self, email: str) -> str:
         """Извлекает username (до первого _)"""
         if '_' in email:
@@ -304,6 +464,8 @@ class BaserowSync:
         if self._baseline_initialized:
             return
         
+        self.prune_missing(users)
+        
         for email, data in users.items():
             total = data.uplink + data.downlink
             # Если у нас нет сохранённого состояния для этого пользователя,
@@ -400,11 +562,17 @@ class BaserowSync:
             print(f"⚠️  Update error: {e}")
             return False
     
-    def sync_user(self, email: str, uplink: int, downlink: int) -> bool:
-        """Синхронизирует пользователя - ИСПРАВЛЕННАЯ ЛОГИКА"""
+    def sync_user(self, email: str, uplink: int, downlink: int, force: bool = False) -> bool:
+        """Синхронизирует пользователя - ИСПРАВЛЕННАЯ ЛОГИКА
+        
+        force=True игнорирует MIN_SYNC_MB (финальная выгрузка удаляемого пользователя)
+        """
         total = uplink + downlink
         
-        if not self.should_sync(email, total):
+        if not self.enabled:
+            return False
+        
+        if not force and not self.should_sync(email, total):
             return False
         
         try:
@@ -584,6 +752,11 @@ def load_config(config_path: str = "/opt/xray-monitor/monitor_config.conf") -> D
         'server_name': 'Unknown',
         'min_sync_mb': 10.0,
         'sync_interval': 5,
+        'xray_config_path': '/usr/local/etc/xray/config.json',
+        'user_ttl': 3600,
+        'max_tracked_users': 10000,
+        'snapshot_enabled': True,
+        'snapshot_path': DEFAULT_SNAPSHOT_PATH,
     }
     
     if not os.path.exists(config_path):
@@ -613,6 +786,16 @@ def load_config(config_path: str = "/opt/xray-monitor/monitor_config.conf") -> D
                         config['min_sync_mb'] = float(value)
                     elif key == 'SYNC_INTERVAL':
                         config['sync_interval'] = int(value)
+                    elif key == 'XRAY_CONFIG_PATH':
+                        config['xray_config_path'] = value
+                    elif key == 'USER_TTL':
+                        config['user_ttl'] = int(value)
+                    elif key == 'MAX_TRACKED_USERS':
+                        config['max_tracked_users'] = int(value)
+                    elif key == 'SNAPSHOT_ENABLED':
+                        config['snapshot_enabled'] = value.lower() == 'true'
+                    elif key == 'SNAPSHOT_PATH':
+                        config['snapshot_path'] = value
     except Exception as e:
         print(f"⚠️  Config error: {e}")
     
@@ -623,7 +806,34 @@ def load_config(config_path: str = "/opt/xray-monitor/monitor_config.conf") -> D
 # MAIN
 # ============================================================================
 
-async def monitoring_loop(client, aggregator, renderer, baserow, interval, sync_interval):
+def retire_users(emails: List[str], aggregator: TrafficAggregator, baserow: Optional[BaserowSync],
+                 retry_after: float) -> List[str]:
+    """Выгружает финальную дельту и забывает пользователей
+    
+    Вызывается только для пользователей, чьих счётчиков уже нет в Xray:
+    пока счётчик жив, его состояние нужно, чтобы не выставить трафик дважды.
+    Пользователи, чью дельту не удалось выгрузить, остаются до следующей попытки.
+    """
+    if not emails:
+        return []
+    
+    retired = emails
+    if baserow:
+        retired = []
+        for email in emails:
+            data = aggregator.users.get(email)
+            if not data or baserow.flush_user(email, data.uplink, data.downlink, retry_after):
+                retired.append(email)
+        baserow.forget_users(retired)
+    
+    aggregator.remove(retired)
+    if retired:
+        print(f"🧹 Evicted {len(retired)} users")
+    return retired
+
+
+async def monitoring_loop(client, aggregator, renderer, baserow, interval, sync_interval, user_index=None,
+                          snapshot=None):
     print(f"🚀 Запуск мониторинга (интервал: {interval}s)...")
     
     if not await client.connect():
@@ -638,6 +848,10 @@ async def monitoring_loop(client, aggregator, renderer, baserow, interval, sync_
             
             stats = await client.query_all_stats()
             
+            removed = []
+            if user_index:
+                user_index.refresh()
+            
             if stats:
                 users = aggregator.update(stats, interval)
                 
@@ -646,6 +860,25 @@ async def monitoring_loop(client, aggregator, renderer, baserow, interval, sync_
                 
                 if baserow:
                     baserow.sync_all(users, sync_interval)
+                
+                if user_index and user_index.removed:
+                    # Удалённые из конфига учитываются как обычно, пока Xray
+                    # отдаёт их счётчики (до перезапуска), затем выгружаются
+                    removed = [e for e in user_index.removed if e not in stats]
+                
+                removed.extend(e for e in aggregator.stale_users(stats) if e not in removed)
+            
+            retired = retire_users(removed, aggregator, baserow, sync_interval * 60)
+            if user_index:
+                user_index.removed.difference_update(retired)
+            
+            if snapshot and (stats or retired):
+                try:
+                    snapshot.publish(aggregator.users, interval)
+                except (OSError, ValueError) as e:
+                    print(f"⚠️  Snapshot error: {e}")
+                    snapshot.close()
+                    snapshot = None
             
             elapsed = time.time() - loop_start
             sleep_time = max(0, interval - elapsed)
@@ -657,6 +890,8 @@ async def monitoring_loop(client, aggregator, renderer, baserow, interval, sync_
             baserow._save_state()
     finally:
         await client.disconnect()
+        if snapshot:
+            snapshot.close()
 
 
 def main():
@@ -670,7 +905,19 @@ def main():
     config = load_config()
     
     client = XrayStatsClient(server=args.server)
-    aggregator = TrafficAggregator()
+    aggregator = TrafficAggregator(
+        user_ttl=config['user_ttl'],
+        max_users=config['max_tracked_users']
+    )
+    user_index = XrayUserIndex(config['xray_config_path'])
+    
+    snapshot = None
+    if config['snapshot_enabled']:
+        try:
+            snapshot = SnapshotWriter(config['snapshot_path'])
+            print(f"🧩 Snapshot: {config['snapshot_path']}")
+        except OSError as e:
+            print(f"⚠️  Could not open snapshot: {e}")
     renderer = ConsoleRenderer() if args.mode in ('console', 'both') else None
     
     baserow = None
@@ -686,7 +933,7 @@ def main():
     try:
         asyncio.run(monitoring_loop(
             client, aggregator, renderer, baserow,
-            args.interval, config['sync_interval']
+            args.interval, config['sync_interval'], user_index, snapshot
         ))
     except KeyboardInterrupt:
         print("\n✅ Завершено")
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Xray Traffic Monitor - Shared-Memory Snapshot
+=============================================
+Монитор публикует счётчики каждого опроса в mmap-файл, локальные процессы
+читают его без обращения к Xray Stats API. Только стандартная библиотека.
+
+Формат (little-endian):
+    HEADER   64 байта: magic, version, seq, timestamp, interval, count, strtab_size
+    RECORDS  count * 40 байт: email_offset, email_len, uplink, downlink, up_speed, down_speed
+    STRTAB   email в UTF-8, без разделителей
+
+Seqlock: writer делает seq нечётным перед записью и чётным после.
+Reader повторяет чтение, пока seq не совпадёт до и после и не будет чётным.
+
+Пример:
+    from xray_snapshot import SnapshotReader
+    with SnapshotReader() as reader:
+        snap = reader.read()
+"""
+
+import fcntl
+import mmap
+import os
+import stat
+import struct
+import sys
+import time
+import json
+from typing import Dict, Optional
+from dataclasses import dataclass, field, asdict
+
+DEFAULT_SNAPSHOT_PATH = "/run/xray-monitor/xray_monitor.snapshot"
+
+MAGIC = b'XRSN'
+VERSION = 1
+
+HEADER = struct.Struct('<4sIQddII')
+HEADER_SIZE = 64
+SEQ_OFFSET = 8
+SEQ = struct.Struct('<Q')
+RECORD = struct.Struct('<IIQQdd')
+
+
+# ============================================================================
+# DATA
+# ============================================================================
+
+@dataclass
+class UserCounters:
+    uplink: int = 0
+    downlink: int = 0
+    up_speed: float = 0.0
+    down_speed: float = 0.0
+
+
+@dataclass
+class Snapshot:
+    seq: int = 0
+    timestamp: float = 0.0
+    interval: float = 0.0
+    users: Dict[str, UserCounters] = field(default_factory=dict)
+
+
+# ============================================================================
+# WRITER
+# ============================================================================
+
+class SnapshotWriter:
+    """Публикует счётчики в mmap-файл (один writer на файл, держит flock)"""
+
+    def __init__(self, path: str = DEFAULT_SNAPSHOT_PATH):
+        self.path = path
+        self._mm: Optional[mmap.mmap] = None
+        self._seq = 0
+
+        self._check_dir(os.path.dirname(os.path.abspath(path)))
+        self._fd = self._open(path)
+
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(self._fd)
+            raise OSError(f"snapshot {path} is locked by another monitor instance")
+
+        size = os.fstat(self._fd).st_size
+        if size >= HEADER_SIZE:
+            self._map(size)
+            magic, version, seq = HEADER.unpack_from(self._mm)[:3]
+            # Продолжаем seq прежнего writer'а, чтобы reader не спутал версии
+            if magic == MAGIC and version == VERSION:
+                self._seq = seq + (seq & 1)
+        else:
+            self._resize(HEADER_SIZE + 256 * RECORD.size)
+
+    @staticmethod
+    def _check_dir(directory: str):
+        # Каталог не должен позволять другим пользователям подменять файл
+        os.makedirs(directory, mode=0o755, exist_ok=True)
+        st = os.stat(directory)
+        if st.st_uid != os.geteuid() or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            raise PermissionError(f"snapshot directory {directory} must be owned by uid {os.geteuid()} "
+                                  f"and not writable by others")
+
+    @staticmethod
+    def _open(path: str) -> int:
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_NOFOLLOW)
+        except FileNotFoundError:
+            # Создаём через временный файл: по path никогда не появится чужой или пустой файл
+            tmp = f"{path}.{os.getpid()}.tmp"
+            fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o644)
+            try:
+                os.ftruncate(fd, HEADER_SIZE + 256 * RECORD.size)
+                os.link(tmp, path)
+            except FileExistsError:
+                os.close(fd)
+                return SnapshotWriter._open(path)
+            except OSError:
+                os.close(fd)
+                raise
+            finally:
+                os.unlink(tmp)
+            return fd
+
+        st = os.fstat(fd)
+        if not stat.S_ISREG(st.st_mode) or st.st_uid != os.geteuid():
+            os.close(fd)
+            raise PermissionError(f"snapshot {path} is not a regular file owned by uid {os.geteuid()}")
+        return fd
+
+    def _map(self, size: int):
+        if self._mm:
+            self._mm.close()
+        self._mm = mmap.mmap(self._fd, size)
+
+    def _resize(self, size: int):
+        # Файл только растёт: старые отображения у reader'ов остаются валидными
+        os.ftruncate(self._fd, size)
+        self._map(size)
+
+    def publish(self, users: Dict, interval: float):
+        """users: email -> объект с uplink/downlink/up_speed/down_speed"""
+        emails = [email.encode('utf-8') for email in users]
+        strtab_offset = HEADER_SIZE + len(emails) * RECORD.size
+        strtab_size = sum(len(e) for e in emails)
+        needed = strtab_offset + strtab_size
+
+        if needed > len(self._mm):
+            self._resize(max(needed, len(self._mm) * 2))
+
+        mm = self._mm
+        self._seq += 1
+        SEQ.pack_into(mm, SEQ_OFFSET, self._seq)
+
+        pos = HEADER_SIZE
+        str_pos = 0
+        for email, data in zip(emails, users.values()):
+            RECORD.pack_into(mm, pos, str_pos, len(email),
+                             data.uplink, data.downlink, data.up_speed, data.down_speed)
+            mm[strtab_offset + str_pos:strtab_offset + str_pos + len(email)] = email
+            pos += RECORD.size
+            str_pos += len(email)
+
+        self._seq += 1
+        HEADER.pack_into(mm, 0, MAGIC, VERSION, self._seq - 1, time.time(), interval,
+                         len(emails), strtab_size)
+        SEQ.pack_into(mm, SEQ_OFFSET, self._seq)
+
+    def close(self):
+        if self._mm:
+            self._mm.close()
+            self._mm = None
+        os.close(self._fd)
+
+
+# ============================================================================
+# READER
+# ============================================================================
+
+class SnapshotReader:
+    """Читает согласованный снимок из mmap-файла без блокировок"""
+
+    def __init__(self, path: str = DEFAULT_SNAPSHOT_PATH):
+        self.path = path
+        self._fd = os.open(path, os.O_RDONLY)
+        self._mm: Optional[mmap.mmap] = None
+        self._remap()
+
+    def _remap(self) -> bool:
+        size = os.fstat(self._fd).st_size
+        if size < HEADER_SIZE:
+            return False
+        if self._mm:
+            self._mm.close()
+        self._mm = mmap.mmap(self._fd, size, access=mmap.ACCESS_READ)
+        return True
+
+    def read(self, retries: int = 100) -> Optional[Snapshot]:
+        """Возвращает снимок или None, если writer не дал прочитать за retries попыток"""
+        for _ in range(retries):
+            if not self._mm and not self._remap():
+                time.sleep(0.001)
+                continue
+
+            mm = self._mm
+            seq_before = SEQ.unpack_from(mm, SEQ_OFFSET)[0]
+            if seq_before & 1:
+                time.sleep(0)
+                continue
+
+            magic, version, seq, timestamp, interval, count, strtab_size = HEADER.unpack_from(mm)
+            if magic != MAGIC or version != VERSION:
+                return None
+
+            strtab_offset = HEADER_SIZE + count * RECORD.size
+            if strtab_offset + strtab_size > len(mm):
+                # Writer увеличил файл
+                self._remap()
+                continue
+
+            users = {}
+            pos = HEADER_SIZE
+            for _ in range(count):
+                str_pos, str_len, uplink, downlink, up_speed, down_speed = RECORD.unpack_from(mm, pos)
+                start = strtab_offset + str_pos
+                email = mm[start:start + str_len].decode('utf-8', errors='replace')
+                users[email] = UserCounters(uplink, downlink, up_speed, down_speed)
+                pos += RECORD.size
+
+            if SEQ.unpack_from(mm, SEQ_OFFSET)[0] == seq_before:
+                return Snapshot(seq_before, timestamp, interval, users)
+
+        return None
+
+    def close(self):
+        if self._mm:
+            self._mm.close()
+            self._mm = None
+        os.close(self._fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    snap = None
+    try:
+        with SnapshotReader(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_SNAPSHOT_PATH) as reader:
+            snap = reader.read()
+    except FileNotFoundError:
+        pass
+    if snap is None:
+        print("❌ Snapshot unavailable", file=sys.stderr)
+        sys.exit(1)
+    print(json.dumps(asdict(snap), indent=2, ensure_ascii=False))